@@ -167,19 +167,16 @@ def readCtfModel(ctfModel, filename):
 def readShiftsMovieAlignment(shiftFn):
     """ Parse movie alignment shifts.
     :param shiftFn: input file to parse
-    :return: two lists with shift values
+    :return: (2, N) array with x and y shift values
     """
+    shifts = []
     with open(shiftFn, 'r') as f:
-        xshifts = []
-        yshifts = []
-
         for line in f:
             line2 = line.strip()
             if line2.startswith('image #'):
                 parts = line2.split()
-                xshifts.append(float(parts[-2].rstrip(',')))
-                yshifts.append(float(parts[-1]))
-    return xshifts, yshifts
+                shifts.append((float(parts[-2].rstrip(',')), float(parts[-1])))
+    return np.array(shifts, dtype=np.float64).reshape(-1, 2).T.copy()
 
 
 def readSetOfCoordinates(workDir, micSet, coordSet):
@@ -234,6 +231,99 @@ def writeReferences(inputSet, outputFn):
         raise TypeError('Invalid object type: %s' % type(inputSet))
 
 
+def _mrcFileName(filename):
+    """ Remove the Scipion ':mrc' or ':mrcs' format suffix, if any. """
+    fn, sep, fmt = filename.rpartition(':')
+    return fn if sep and fmt in ('mrc', 'mrcs') else filename
+
+
+def _readMrcHeader(filename):
+    """ Return the 1024 bytes main header of a little-endian,
+    float32 (mode 2) MRC file or None for any other file,
+    including files shorter than their header claims. """
+    if os.path.splitext(filename)[1] not in ('.mrc', '.mrcs', '.st'):
+        return None
+    header = np.fromfile(filename, dtype=np.uint8, count=1024)
+    if header.size < 1024 or header[212] != 0x44:  # machine stamp
+        return None
+    intHeader = header.view('<i4')
+    if intHeader[3] != 2:
+        return None
+    nx, ny, nz, nsymbt = (int(v) for v in intHeader[[0, 1, 2, 23]])
+    if min(nx, ny, nz, nsymbt + 1) <= 0:
+        return None
+    if os.path.getsize(filename) < 1024 + nsymbt + nx * ny * nz * 4:
+        return None
+    return header
+
+
+def writeMrcStack(locations, outputFn):
+    """ Write a 2D images stack by copying the images directly
+    from the input MRC files, without going through ImageHandler.
+    All inputs must be float32 MRC files with the same dimensions.
+    :param locations: list of (index, filename) of the input images,
+        filenames may have a ':mrcs' suffix
+    :param outputFn: output MRC stack
+    :return: False (nothing written) if the inputs are not supported
+    """
+    locations = [(index, _mrcFileName(fn)) for index, fn in locations]
+    headers = {}
+    for _, fn in locations:
+        if fn not in headers:
+            headers[fn] = _readMrcHeader(fn)
+            if headers[fn] is None:
+                logger.info(f"Not a little-endian float32 MRC file: {fn}")
+                return False
+    dims = {tuple(h.view('<i4')[:2]) for h in headers.values()}
+    if len(dims) != 1:
+        logger.info(f"Input MRC files have different dimensions: {dims}")
+        return False
+
+    nx, ny = dims.pop()
+    n = len(locations)
+    # images copied at once, about 256 MB in memory
+    blockSize = max(1, (256 << 20) // (nx * ny * 4))
+    output = np.memmap(outputFn, dtype='<f4', mode='w+', offset=1024,
+                       shape=(n, ny, nx))
+
+    # copy all images coming from the same file at once
+    indexes = {}
+    for i, (index, fn) in enumerate(locations):
+        indexes.setdefault(fn, ([], []))
+        indexes[fn][0].append(i)
+        indexes[fn][1].append(max(index, 1) - 1)
+
+    for fn, (outIdx, inIdx) in indexes.items():
+        intHeader = headers[fn].view('<i4')
+        inputStack = np.memmap(fn, dtype='<f4', mode='r',
+                               offset=1024 + int(intHeader[23]),
+                               shape=(int(intHeader[2]), ny, nx))
+        for start in range(0, len(outIdx), blockSize):
+            end = start + blockSize
+            output[outIdx[start:end]] = inputStack[inIdx[start:end]]
+        del inputStack
+
+    output.flush()
+    del output
+
+    # header of the first input file, updated for an n images stack
+    header = next(iter(headers.values())).copy()
+    intHeader, floatHeader = header.view('<i4'), header.view('<f4')
+    intHeader[2] = n  # nz
+    intHeader[9] = 1  # mz
+    if intHeader[7] > 0:
+        floatHeader[12] = floatHeader[10] / intHeader[7]  # cella z
+    intHeader[22] = 0  # ispg, image stack
+    intHeader[23] = 0  # nsymbt, no extended header
+    floatHeader[19] = 0.  # dmin > dmax and rms < 0 mean
+    floatHeader[20] = -1.  # statistics are not computed
+    floatHeader[54] = -1.
+    with open(outputFn, 'r+b') as f:
+        f.write(header.tobytes())
+
+    return True
+
+
 def rowToAlignment(alignmentRow, samplingRate):
     """ Return an Transform object representing the Alignment
     from a given parFile row.
@@ -241,16 +331,26 @@ def rowToAlignment(alignmentRow, samplingRate):
     :param samplingRate: input pixel size
     :return Transform object
     """
-    angles = np.zeros(3)
-    shifts = np.zeros(3)
+    return parToAlignment(float(alignmentRow.get('PSI')),
+                          float(alignmentRow.get('THETA')),
+                          float(alignmentRow.get('PHI')),
+                          float(alignmentRow.get('SHX')),
+                          float(alignmentRow.get('SHY')),
+                          samplingRate)
+
+
+def parToAlignment(psi, theta, phi, shx, shy, samplingRate):
+    """ Return an Transform object from the
+    alignment values of a parFile row.
+    :param psi, theta, phi: input angles
+    :param shx, shy: input shifts in Angstroms
+    :param samplingRate: input pixel size
+    :return Transform object
+    """
     alignment = Transform()
-    # PSI   THETA     PHI       SHX       SHY
-    angles[0] = float(alignmentRow.get('PSI'))
-    angles[1] = float(alignmentRow.get('THETA'))
-    angles[2] = float(alignmentRow.get('PHI'))
+    angles = np.array([psi, theta, phi])
     # shifts are converted from Angstroms to px
-    shifts[0] = float(alignmentRow.get('SHX')) / samplingRate
-    shifts[1] = float(alignmentRow.get('SHY')) / samplingRate
+    shifts = np.array([shx / samplingRate, shy / samplingRate, 0.])
 
     M = matrixFromGeometry(shifts, angles)
     alignment.setMatrix(M)
@@ -275,6 +375,35 @@ def matrixFromGeometry(shifts, angles):
     return M
 
 
+def matricesFromGeometry(shifts, angles):
+    """ Vectorized version of matrixFromGeometry.
+    :param shifts: input array of shape (n, 3)
+    :param angles: input array of shape (n, 3)
+    :return: array of shape (n, 4, 4)
+    """
+    # transformations.euler_matrix with axes='szyz'
+    ai, aj, ak = np.deg2rad(angles).T
+    si, sj, sk = np.sin(ai), np.sin(aj), np.sin(ak)
+    ci, cj, ck = np.cos(ai), np.cos(aj), np.cos(ak)
+    cc, cs = ci * ck, ci * sk
+    sc, ss = si * ck, si * sk
+
+    M = np.zeros((len(ai), 4, 4))
+    M[:, 2, 2] = cj
+    M[:, 2, 1] = sj * si
+    M[:, 2, 0] = sj * ci
+    M[:, 1, 2] = sj * sk
+    M[:, 1, 1] = -cj * ss + cc
+    M[:, 1, 0] = -cj * cs - sc
+    M[:, 0, 2] = -sj * ck
+    M[:, 0, 1] = cj * sc + cs
+    M[:, 0, 0] = cj * cc - ss
+    M[:, 3, 3] = 1.0
+    M[:, :3, 3] = -shifts[:, :3]
+
+    return np.linalg.inv(M)
+
+
 def geometryFromMatrix(matrix):
     """ Convert the transformation matrix to shifts and angles.
     :param matrix: input matrix
@@ -285,3 +414,29 @@ def geometryFromMatrix(matrix):
     angles = -np.rad2deg(transformations.euler_from_matrix(matrix, axes='szyz'))
 
     return shifts, angles
+
+
+def splitParticleRanges(numPtcls, jobs):
+    """ Split particles 1..numPtcls into contiguous ranges.
+    :param numPtcls: number of particles
+    :param jobs: requested number of ranges, capped to numPtcls
+    :return: list of (first, last) 1-based, inclusive ranges
+    """
+    jobs = min(jobs, numPtcls)
+    bounds = np.linspace(1, numPtcls + 1, jobs + 1, dtype=int)
+    return [(int(first), int(last) - 1)
+            for first, last in zip(bounds[:-1], bounds[1:])]
+
+
+def psiFromMatrices(matrices):
+    """ Vectorized version of geometryFromMatrix that only returns
+    the psi angle (angles[2]) for a stack of transformation matrices.
+    :param matrices: input array of shape (n, 4, 4)
+    :return: array with n psi angles
+    """
+    R = np.linalg.inv(matrices)[:, :3, :3]
+    # same 'szyz' convention as transformations.euler_from_matrix
+    sy = np.hypot(R[:, 2, 1], R[:, 2, 0])
+    psi = np.rad2deg(np.arctan2(R[:, 1, 2], -R[:, 0, 2]))
+
+    return np.where(sy > np.finfo(float).eps * 4.0, psi, 0.0)
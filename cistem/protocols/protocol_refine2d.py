@@ -27,29 +27,25 @@
 # **************************************************************************
 
 import os
-import re
 import sys
-from glob import glob
-from collections import OrderedDict
 from enum import Enum
 import asyncio
+import numpy as np
 
 from pyworkflow.protocol import STEPS_SERIAL
 from pyworkflow.constants import PROD
 from pyworkflow.protocol.params import (PointerParam, FloatParam,
                                         IntParam, BooleanParam,
                                         StringParam)
-from pyworkflow.utils.path import (makePath, createLink,
-                                   cleanPattern, moveFile)
+from pyworkflow.utils.path import makePath
 from pyworkflow.utils import greenStr
 from pyworkflow.object import Float
-from pyworkflow.utils.process import buildRunCommand
 from pwem.protocols import ProtClassify2D
-from pwem.objects import SetOfClasses2D
+from pwem.objects import SetOfClasses2D, Transform
 
 from cistem import Plugin
-from ..convert import (writeReferences, geometryFromMatrix,
-                       rowToAlignment, HEADER_COLUMNS)
+from ..convert import (writeReferences, writeMrcStack, psiFromMatrices,
+                       matricesFromGeometry, splitParticleRanges)
 
 
 class outputs(Enum):
@@ -65,6 +61,10 @@ class CistemProtRefine2D(ProtClassify2D):
     def __init__(self, **args):
         ProtClassify2D.__init__(self, **args)
         self.stepsExecutionMode = STEPS_SERIAL
+        self._fnCache = {}
+        self._numPtcls = None
+        self._partTable = None
+        self._refineSchedule = None
 
     def _createFilenameTemplates(self):
         """ Centralize the names of the files. """
@@ -78,17 +78,29 @@ class CistemProtRefine2D(ProtClassify2D):
             'iter_cls_block_seed': 'Refine2D/ClassAverages/class_dump_file_%(iter)d_.dump'
         }
         self._updateFilenamesDict(myDict)
+        self._fnCache.clear()
+
+    def _getFileName(self, key, **kwargs):
+        """ Same as Protocol._getFileName, but results are cached
+        since the same names are requested for every iteration. """
+        cacheKey = (key, tuple(sorted(kwargs.items())))
+        if cacheKey not in self._fnCache:
+            self._fnCache[cacheKey] = ProtClassify2D._getFileName(self, key,
+                                                                  **kwargs)
+        return self._fnCache[cacheKey]
 
     def _createIterTemplates(self):
-        """ Setup the regex on how to find iterations. """
+        """ Setup the folder, prefix and suffix on how to find iterations. """
         parFn = self._getExtraPath(self._getFileName('iter_par',
                                                      iter=0))
-        self._iterTemplate = parFn.replace('0', '*')
-        self._iterRegex = re.compile(r'input_par_(\d{1,2})')
+        self._iterDir = os.path.dirname(parFn)
+        self._iterPrefix, self._iterSuffix = os.path.basename(parFn).split('0')
 
     def _initialize(self):
         self._createFilenameTemplates()
         self._createIterTemplates()
+        self._refineArgs = self._getRefineArgs()
+        self._refineInput = self._getRefineInput()
 
     # --------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -260,8 +272,7 @@ class CistemProtRefine2D(ProtClassify2D):
 
     # --------------------------- INSERT steps functions ----------------------
     def _insertAllSteps(self):
-        self._createFilenameTemplates()
-        self._createIterTemplates()
+        self._initialize()
         self._insertContinueStep()
         self._insertItersSteps()
         self._insertFunctionStep("createOutputStep")
@@ -271,6 +282,7 @@ class CistemProtRefine2D(ProtClassify2D):
             continueRun = self.continueRun.get()
             continueRun._initialize()
             self.inputParticles.set(None)
+            self._numPtcls = None  # input now comes from the previous run
             self.numberOfClassAvg.set(continueRun.numberOfClassAvg.get())
             if self.continueIter.get() == 'last':
                 self.initIter = continueRun._lastIter() + 1
@@ -285,7 +297,6 @@ class CistemProtRefine2D(ProtClassify2D):
     def _insertItersSteps(self):
         """ Insert the steps for all iterations. """
         self._insertFunctionStep('convertInputStep')
-        self.currPtcl = 1
         for iterN in self._allItersN():
             paramsDic = self._getParamsIteration(iterN)
             depsRefine = self._insertRefineIterStep(iterN, paramsDic)
@@ -310,16 +321,28 @@ class CistemProtRefine2D(ProtClassify2D):
         return depsRefine
 
     async def _parallelWorker(self, job_list):
-        process_list = []
+        """ Run all jobs concurrently, at most one per available cpu.
+        Each job is a tuple of (argv, input) where input is fed
+        to the program stdin. Return the list of jobs return codes. """
+        semaphore = asyncio.Semaphore(min(len(job_list), os.cpu_count() or 1))
+
+        async def runJob(argv, cmdInput, **kwargs):
+            async with semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    *argv, stdin=asyncio.subprocess.PIPE,
+                    cwd=self._getExtraPath(), env=Plugin.getEnviron(), **kwargs)
+                await process.communicate(cmdInput.encode())
+                return process.returncode
+
         self.info(greenStr(f'Starting {len(job_list)} parallel refine2d commands.'))
-        for job in job_list[:-1]:
-            # Add without logging to STDOUT to avoid crazy logs
-            process_list.append(await asyncio.create_subprocess_shell(job, cwd=self._getExtraPath()))
+        # Discard the output of all but the last job to avoid crazy logs,
+        # errors of every job are still logged
+        tasks = [runJob(*job, stdout=asyncio.subprocess.DEVNULL,
+                        stderr=sys.stderr)
+                 for job in job_list[:-1]]
         self.info(f'Only logging job #{len(job_list)} to avoid polluting the log file.')
-        process_list.append(
-            await asyncio.create_subprocess_shell(job_list[-1], cwd=self._getExtraPath(), stdout=sys.stdout,
-                                                  stderr=sys.stderr))
-        await asyncio.gather(*[process.wait() for process in process_list])
+        tasks.append(runJob(*job_list[-1], stdout=sys.stdout, stderr=sys.stderr))
+        return await asyncio.gather(*tasks)
 
     # --------------------------- STEPS functions -----------------------------
     def continueStep(self, iterN):
@@ -327,17 +350,18 @@ class CistemProtRefine2D(ProtClassify2D):
         iterN -= 1
         continueRun = self.continueRun.get()
         self._createWorkingDirs()
-        # link particles
-        prevStack = continueRun._getFileName('run_stack', run=0)
-        currStack = self._getFileName('run_stack', run=0)
-        createLink(continueRun._getExtraPath(prevStack),
-                   self._getExtraPath(currStack))
-        # link params & cls
-        for fn in ['iter_par', 'iter_cls']:
-            prevParam = continueRun._getFileName(fn, iter=iterN)
-            currParam = self._getFileName(fn, iter=iterN)
-            createLink(continueRun._getExtraPath(prevParam),
-                       self._getExtraPath(currParam))
+        # link particles, params & cls
+        links = [('run_stack', {'run': 0}),
+                 ('iter_par', {'iter': iterN}),
+                 ('iter_cls', {'iter': iterN})]
+        for key, kwargs in links:
+            prevFn = continueRun._getExtraPath(continueRun._getFileName(key, **kwargs))
+            currFn = self._getExtraPath(self._getFileName(key, **kwargs))
+            try:
+                os.symlink(os.path.relpath(prevFn, os.path.dirname(currFn)),
+                           currFn)
+            except FileExistsError:
+                pass
 
     def convertInputStep(self):
         """ Prepare working dir, convert input particles
@@ -358,33 +382,38 @@ class CistemProtRefine2D(ProtClassify2D):
         """ Construct a parameter file (.par).
         This function will be called only for iterations 1 and 2. """
         parFn = self._getExtraPath(self._getFileName('iter_par', iter=1))
+        table = self._loadParticleTable()
+        numPtcls = len(table['defocusU'])
+        if table['matrix'] is not None:
+            psi = psiFromMatrices(table['matrix'])
+        else:
+            psi = np.zeros(numPtcls)
+
+        zeros = np.zeros(numPtcls)
+        rows = np.column_stack((np.arange(1, numPtcls + 1), psi,
+                                zeros, zeros, zeros, zeros, zeros, zeros,
+                                table['defocusU'], table['defocusV'],
+                                table['defocusAngle'], table['phaseShift'],
+                                np.full(numPtcls, 100.), zeros,
+                                np.full(numPtcls, 10.), zeros, zeros))
+
         with open(parFn, 'w') as f:
             f.write("C           PSI   THETA     PHI       SHX       SHY     MAG  "
                     "FILM      DF1      DF2  ANGAST  PSHIFT     OCC      LogP"
                     "      SIGMA   SCORE  CHANGE\n")
-            hasAlignment = self.hasAlignment()
+            rowFmt = ('%7d%8.2f%8.2f%8.2f%10.2f%10.2f%8d%6d%9.1f%9.1f'
+                      '%8.2f%8.2f%8.2f%10d%11.4f%8.2f%8.2f\n')
+            # format blocks of rows at once to reduce the number of writes
+            blockSize = 10000
+            for start in range(0, numPtcls, blockSize):
+                block = rows[start:start + blockSize]
+                f.write((rowFmt * len(block)) % tuple(block.ravel().tolist()))
 
-            for i, part in self.iterParticlesByMic():
-                ctf = part.getCTF()
-                defocusU, defocusV = ctf.getDefocusU(), ctf.getDefocusV()
-                astig = ctf.getDefocusAngle()
-                phaseShift = ctf.getPhaseShift() or 0.00
-
-                if hasAlignment:
-                    _, angles = geometryFromMatrix(part.getTransform().getMatrix())
-                    psi = angles[2]
-                else:
-                    psi = 0.0
-
-                string = '%7d%8.2f%8.2f%8.2f%10.2f%10.2f%8d%6d%9.1f%9.1f' \
-                         '%8.2f%8.2f%8.2f%10d%11.4f%8.2f%8.2f\n' % (
-                             i + 1, psi, 0., 0., 0., 0., 0, 0, defocusU, defocusV,
-                             astig, phaseShift, 100., 0, 10., 0., 0.)
-
-                f.write(string)
+        # the table is not needed by the refinement iterations
+        self._partTable = None
 
     def makeInitClassesStep(self, paramsDic):
-        argsStr = self._getRefineArgs()
+        argsStr = self._refineArgs
         percUsed = self.numberOfClassAvg.get() * 300.0
         percUsed = percUsed / self._getPtclsNumber() * 100.0
         if percUsed > 100.0:
@@ -404,98 +433,30 @@ class CistemProtRefine2D(ProtClassify2D):
                     cwd=self._getExtraPath(),
                     env=Plugin.getEnviron())
 
-    def prepareRefineStep(self, iterN, job, ptcls_per_job, paramsDic):
-        numPtcls = self._getPtclsNumber()
-
-        if job == 1:
-            firstPart = 1
-            lastPart = 1 + int(ptcls_per_job)
-            self.currPtcl = lastPart + 1
-        else:
-            firstPart = self.currPtcl
-            lastPart = firstPart + int(ptcls_per_job)
-            if lastPart > numPtcls:
-                lastPart = numPtcls
-            self.currPtcl = lastPart + 1
-
-        argsStr = self._getRefineArgs()
-        highRes = self._calcHighResLimit(self.finalIter,
-                                         self.highResLimit1.get(),
-                                         self.highResLimit2.get())
-
-        percUsed = self._calcPercUsed(self.finalIter,
-                                      iterN - 1,
-                                      self.numberOfClassAvg.get(),
-                                      numPtcls,
-                                      self.percUsed.get(),
-                                      self.autoPerc)
-
-        paramsDic.update({
-            'output_params': self._getFileName('iter_par_block', iter=iterN,
-                                               block=job),
-            'numberOfClassAvg': 0,  # determined from cls stack
-            'firstPart': firstPart,
-            'lastPart': lastPart,
-            'percUsed': percUsed / 100.0,
-            'highRes': highRes,
-            'dump': 'YES',
-            'dumpFn': self._getFileName('iter_cls_block', iter=iterN,
-                                        block=job)
-        })
-        cmdArgs = argsStr % paramsDic
-        return buildRunCommand(self._getProgram(), numberOfMpi=1, params=cmdArgs, env=Plugin.getEnviron()), paramsDic
+    def prepareRefineStep(self, iterN, job, ptclsRange, paramsDic):
+        paramsDic = self._buildRefineJob(iterN, job, ptclsRange, paramsDic)
+        cmdInput = self._refineInput % paramsDic
+        return ([self._getProgram()], cmdInput), paramsDic
 
     def refineParallelStep(self, iterN, paramsDic):
-        jobs, ptcls_per_job = self._getJobsParams()
+        _, ptclsRanges = self._getJobsParams()
+        paramsDic = self._getRefineIterParams(iterN, paramsDic)
         jobs_list = []
-        for job in range(1, jobs + 1):
-            preparedStep, paramsDic = self.prepareRefineStep(iterN, job, ptcls_per_job, paramsDic)
+        for job, ptclsRange in enumerate(ptclsRanges, start=1):
+            preparedStep, paramsDic = self.prepareRefineStep(iterN, job, ptclsRange, paramsDic)
             jobs_list.append(preparedStep)
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        asyncio.run(self._parallelWorker(jobs_list))
-        loop.close()
-
-    def refineStep(self, iterN, job, ptcls_per_job, paramsDic):
-        numPtcls = self._getPtclsNumber()
-
-        if job == 1:
-            firstPart = 1
-            lastPart = 1 + int(ptcls_per_job)
-            self.currPtcl = lastPart + 1
-        else:
-            firstPart = self.currPtcl
-            lastPart = firstPart + int(ptcls_per_job)
-            if lastPart > numPtcls:
-                lastPart = numPtcls
-            self.currPtcl = lastPart + 1
-
-        argsStr = self._getRefineArgs()
-        highRes = self._calcHighResLimit(self.finalIter,
-                                         self.highResLimit1.get(),
-                                         self.highResLimit2.get())
-
-        percUsed = self._calcPercUsed(self.finalIter,
-                                      iterN - 1,
-                                      self.numberOfClassAvg.get(),
-                                      numPtcls,
-                                      self.percUsed.get(),
-                                      self.autoPerc)
-
-        paramsDic.update({
-            'output_params': self._getFileName('iter_par_block', iter=iterN,
-                                               block=job),
-            'numberOfClassAvg': 0,  # determined from cls stack
-            'firstPart': firstPart,
-            'lastPart': lastPart,
-            'percUsed': percUsed / 100.0,
-            'highRes': highRes,
-            'dump': 'YES',
-            'dumpFn': self._getFileName('iter_cls_block', iter=iterN,
-                                        block=job)
-        })
-
-        cmdArgs = argsStr % paramsDic
+        returnCodes = asyncio.run(self._parallelWorker(jobs_list))
+        failed = ["#%d (particles %d-%d)" % (job, first, last)
+                  for job, ((first, last), code) in
+                  enumerate(zip(ptclsRanges, returnCodes), start=1) if code]
+        if failed:
+            raise RuntimeError("Refine2d failed at iteration %d for jobs %s"
+                               % (iterN, ", ".join(failed)))
+
+    def refineStep(self, iterN, job, ptclsRange, paramsDic):
+        paramsDic = self._getRefineIterParams(iterN, paramsDic)
+        paramsDic = self._buildRefineJob(iterN, job, ptclsRange, paramsDic)
+        cmdArgs = self._refineArgs % paramsDic
         self.runJob(self._getProgram(), cmdArgs,
                     cwd=self._getExtraPath(),
                     env=Plugin.getEnviron())
@@ -516,8 +477,14 @@ class CistemProtRefine2D(ProtClassify2D):
                     cwd=self._getExtraPath(),
                     env=Plugin.getEnviron())
 
-        dumpFns = self._getExtraPath('Refine2D/ClassAverages/class_dump_file_%d_*' % iterN)
-        cleanPattern(dumpFns)
+        dumpPrefix = 'class_dump_file_%d_' % iterN
+        with os.scandir(self._getExtraPath('Refine2D/ClassAverages')) as entries:
+            for entry in entries:
+                if entry.name.startswith(dumpPrefix):
+                    try:
+                        os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
 
     def createOutputStep(self):
         partSet = self._getInputParticles()
@@ -631,33 +598,46 @@ class CistemProtRefine2D(ProtClassify2D):
         return self._getInputParticlesPointer().get()
 
     def _getPtclsNumber(self):
-        return self._getInputParticles().getSize()
+        """ Return the number of input particles, the set size
+        is only queried once. """
+        if self._numPtcls is None:
+            self._numPtcls = self._getInputParticles().getSize()
+        return self._numPtcls
 
     def _getJobsParams(self):
-        jobs = max(self.numberOfThreads.get(),
-                   self.numberOfMpi.get())
-        parts = self._getPtclsNumber()
-        if parts - jobs < jobs:
-            ptcls_per_job = 1.0
-        else:
-            ptcls_per_job = round(float(parts / jobs))
+        """ Return the number of jobs and the (first, last) particle
+        range of each job. Ranges are 1-based, inclusive and
+        split the particles contiguously without overlaps. """
+        ptclsRanges = splitParticleRanges(self._getPtclsNumber(),
+                                          max(self.numberOfThreads.get(),
+                                              self.numberOfMpi.get()))
 
-        return jobs, ptcls_per_job
+        return len(ptclsRanges), ptclsRanges
 
     def _getIterNumber(self, index):
-        """ Return the list of iteration files, give the iterTemplate. """
-
-        def regexKey(x):
-            s = re.search(self._iterRegex, x)
-            return int(s.groups()[0])
-
-        result = None
-        files = glob(self._iterTemplate)
-
-        if files:
-            sorted_files = sorted(map(regexKey, files))
-            result = sorted_files[index]
-        return result
+        """ Return the iteration number at index from the sorted list
+        of iteration files found in the iterations folder. """
+        prefix, suffix = self._iterPrefix, self._iterSuffix
+        iters = []
+
+        try:
+            with os.scandir(self._iterDir) as entries:
+                for entry in entries:
+                    name = entry.name
+                    if name.startswith(prefix) and name.endswith(suffix):
+                        num = name[len(prefix):-len(suffix)]
+                        if num.isdigit():
+                            iters.append(int(num))
+        except FileNotFoundError:
+            pass
+
+        if not iters:
+            return None
+        elif index == -1:
+            return max(iters)
+        elif index == 0:
+            return min(iters)
+        return sorted(iters)[index]
 
     def _lastIter(self):
         return self._getIterNumber(-1)
@@ -695,13 +675,18 @@ class CistemProtRefine2D(ProtClassify2D):
                              iterParams=params)
 
     def _updateParticle(self, item, row):
-        vals = OrderedDict(zip(HEADER_COLUMNS, row))
-        item.setClassId(vals.get('FILM'))
-        item.setTransform(rowToAlignment(vals, item.getSamplingRate()))
-        item._cistemLogP = Float(vals.get('LogP'))
-        item._cistemSigma = Float(vals.get('SIGMA'))
-        item._cistemOCC = Float(vals.get('OCC'))
-        item._cistemScore = Float(vals.get('SCORE'))
+        values, matrix = row
+        # unpack the row in HEADER_COLUMNS order
+        (_, _, _, _, _, _, _, film, _, _, _, _,
+         occ, logP, sigma, score, _) = values
+        item.setClassId(int(film))
+        alignment = Transform()
+        alignment.setMatrix(matrix)
+        item.setTransform(alignment)
+        item._cistemLogP = Float(logP)
+        item._cistemSigma = Float(sigma)
+        item._cistemOCC = Float(occ)
+        item._cistemScore = Float(score)
 
     def _updateClass(self, item):
         classId = item.getObjId()
@@ -711,11 +696,15 @@ class CistemProtRefine2D(ProtClassify2D):
 
     def _iterRows(self, iterN):
         filePar = self._getFileName('iter_par', iter=iterN)
-        with open(self._getExtraPath(filePar)) as f1:
-            for line in f1:
-                if not line.startswith("C"):
-                    values = map(float, line.strip().split())
-                    yield values
+        rows = np.loadtxt(self._getExtraPath(filePar), comments='C', ndmin=2)
+        # alignment matrices of all particles from PSI THETA PHI SHX SHY,
+        # shifts are converted from Angstroms to px
+        shifts = np.zeros((len(rows), 3))
+        shifts[:, :2] = rows[:, 4:6] / self._getInputParticles().getSamplingRate()
+        matrices = matricesFromGeometry(shifts, rows[:, 1:4])
+
+        for values, matrix in zip(rows.tolist(), matrices):
+            yield values, matrix
 
     def iterParticlesByMic(self):
         """ Iterate the particles ordered by micrograph """
@@ -723,11 +712,50 @@ class CistemProtRefine2D(ProtClassify2D):
                                                                      direction='ASC')):
             yield i, part
 
+    def _loadParticleTable(self):
+        """ Read image locations, CTF values and alignment matrices of
+        the input particles (ordered by mic) into numpy arrays. The result
+        is cached so the particle set is only traversed once, and it is
+        released by writeInitParStep. """
+        if self._partTable is None:
+            numPtcls = self._getPtclsNumber()
+            hasAlignment = self.hasAlignment()
+            table = {
+                'location': [],
+                'defocusU': np.empty(numPtcls),
+                'defocusV': np.empty(numPtcls),
+                'defocusAngle': np.empty(numPtcls),
+                'phaseShift': np.empty(numPtcls),
+                'matrix': np.empty((numPtcls, 4, 4)) if hasAlignment else None
+            }
+
+            for i, part in self.iterParticlesByMic():
+                table['location'].append(part.getLocation())
+                ctf = part.getCTF()
+                table['defocusU'][i] = ctf.getDefocusU()
+                table['defocusV'][i] = ctf.getDefocusV()
+                table['defocusAngle'][i] = ctf.getDefocusAngle()
+                table['phaseShift'][i] = ctf.getPhaseShift() or 0.00
+
+                if hasAlignment:
+                    table['matrix'][i] = part.getTransform().getMatrix()
+
+            self._partTable = table
+
+        return self._partTable
+
     def writeParticlesByMic(self, stackFn):
-        """ Cistem requires input particle stack ordered by mic. """
-        self._getInputParticles().writeStack(stackFn,
-                                             orderBy=['_micId', 'id'],
-                                             direction='ASC')
+        """ Cistem requires input particle stack ordered by mic.
+        MRC inputs are copied directly, other formats are converted. """
+        locations = self._loadParticleTable()['location']
+        if writeMrcStack(locations, stackFn):
+            self.info("Input MRC particles copied directly to %s" % stackFn)
+        else:
+            self.info("Input particles are not all float32 MRC files, "
+                      "converting them to %s" % stackFn)
+            self._getInputParticles().writeStack(stackFn,
+                                                 orderBy=['_micId', 'id'],
+                                                 direction='ASC')
 
     def hasAlignment(self):
         inputParts = self._getInputParticles()
@@ -770,9 +798,58 @@ class CistemProtRefine2D(ProtClassify2D):
 
         return paramsDic
 
+    def _getRefineIterParams(self, iterN, paramsDic):
+        """ Return a copy of paramsDic updated with the refine2d
+        params that are the same for all jobs of an iteration. """
+        highRes, percUsedTable = self._getRefineSchedule()
+
+        return dict(paramsDic,
+                    numberOfClassAvg=0,  # determined from cls stack
+                    percUsed=percUsedTable[iterN - 1] / 100.0,
+                    highRes=highRes,
+                    dump='YES')
+
+    def _getRefineSchedule(self):
+        """ Return the high resolution limit and an array with the
+        percent used for each number of done iterations. Both are
+        computed only once per run. """
+        if self._refineSchedule is None:
+            highRes = self._calcHighResLimit(self.finalIter,
+                                             self.highResLimit1.get(),
+                                             self.highResLimit2.get())
+            numCls = self.numberOfClassAvg.get()
+            numPtcls = self._getPtclsNumber()
+            percUsedTable = np.fromiter(
+                (self._calcPercUsed(self.finalIter, iterDone, numCls,
+                                    numPtcls, self.percUsed.get(),
+                                    self.autoPerc)
+                 for iterDone in range(self.finalIter)), dtype=float)
+            self._refineSchedule = highRes, percUsedTable
+
+        return self._refineSchedule
+
+    def _buildRefineJob(self, iterN, job, ptclsRange, paramsDic):
+        """ Update paramsDic with the particles range and the
+        output files of a single refine2d job. """
+        firstPart, lastPart = ptclsRange
+
+        paramsDic.update({
+            'output_params': self._getFileName('iter_par_block', iter=iterN,
+                                               block=job),
+            'firstPart': firstPart,
+            'lastPart': lastPart,
+            'dumpFn': self._getFileName('iter_cls_block', iter=iterN,
+                                        block=job)
+        })
+        return paramsDic
+
     def _getRefineArgs(self):
-        argsStr = """ << eof
-%(input_stack)s
+        argsStr = " << eof\n%seof\n" % self._getRefineInput()
+        return argsStr
+
+    def _getRefineInput(self):
+        """ Parameters that refine2d reads from stdin. """
+        inputStr = """%(input_stack)s
 %(input_params)s
 %(input_cls)s
 %(output_params)s
@@ -798,39 +875,48 @@ class CistemProtRefine2D(ProtClassify2D):
 %(exclEdges)s
 %(dump)s
 %(dumpFn)s
-eof
 """
-        return argsStr
+        return inputStr
 
     def _mergeAllParFiles(self, iterN, numberOfBlocks):
         """ This method merge all parameters files that has been
         created in a refineStep. """
-        self._enterDir(self._getExtraPath())
-        outFn = self._getFileName('iter_par', iter=iterN)
+        outFn = self._getExtraPath(self._getFileName('iter_par', iter=iterN))
 
         if numberOfBlocks != 1:
-            f1 = open(outFn, 'w+')
-            f1.write("C           PSI   THETA     PHI       SHX       SHY     MAG  "
+            parts = ["C           PSI   THETA     PHI       SHX       SHY     MAG  "
                      "FILM      DF1      DF2  ANGAST  PSHIFT     OCC      LogP"
-                     "      SIGMA   SCORE  CHANGE\n")
+                     "      SIGMA   SCORE  CHANGE\n"]
+            parFns = []
             for block in range(1, numberOfBlocks + 1):
-                parFn = self._getFileName('iter_par_block', iter=iterN,
-                                          block=block)
+                parFn = self._getExtraPath(self._getFileName('iter_par_block',
+                                                             iter=iterN,
+                                                             block=block))
                 if not os.path.exists(parFn):
                     raise FileNotFoundError("Error: file %s does not exist" % parFn)
-                f2 = open(parFn)
-
-                for l in f2:
-                    if not l.startswith('C'):
-                        f1.write(l)
-                f2.close()
-                cleanPattern(parFn)
-            f1.close()
-        else:
-            parFn = self._getFileName('iter_par_block', iter=iterN, block=1)
-            moveFile(parFn, outFn)
 
-        self._leaveDir()
+                with open(parFn) as f2:
+                    # skip the header lines, then keep the rest as is
+                    line = f2.readline()
+                    while line.startswith('C'):
+                        line = f2.readline()
+                    parts.append(line)
+                    parts.append(f2.read())
+                parFns.append(parFn)
+
+            # write all blocks at once, make sure the merged file is
+            # on disk before removing the blocks
+            with open(outFn, 'w') as f1:
+                f1.write(''.join(parts))
+                f1.flush()
+                os.fsync(f1.fileno())
+
+            for parFn in parFns:
+                os.unlink(parFn)
+        else:
+            parFn = self._getExtraPath(self._getFileName('iter_par_block',
+                                                         iter=iterN, block=1))
+            os.replace(parFn, outFn)
 
     def _getMergeArgs(self):
         argsStr = """ << eof
@@ -34,7 +34,6 @@ from pyworkflow import BETA
 from pyworkflow.protocol import PointerParam, IntParam
 from pyworkflow.utils import *
 from tomo.objects import SetOfTomograms, Tomogram
-from pwem.convert.headers import Ccp4Header
 
 OUTPUT_TOMO_NAME = 'resampledTomos'
 OUTPUT_DIR = 'extra/'
@@ -51,8 +50,6 @@ class ProtTomoResample(EMProtocol):
     _possibleOutputs = {OUTPUT_TOMO_NAME: SetOfTomograms}
     _devStatus = BETA
 
-    tomoList = []
-
     def __init__(self, **args):
         EMProtocol.__init__(self, **args)
 
@@ -116,13 +113,10 @@ class ProtTomoResample(EMProtocol):
         prog = Plugin.getProgram('resample')
 
 
-        tomoBaseName = removeBaseExt(tomoFile)
-        tomoExt = getExt(tomoFile)
         paramDict = {}
         paramDict['tomoFile'] = tomoFile
-        paramDict['tomoOutName'] = self.getWorkingDir() + '/' + OUTPUT_DIR + '/' + \
-            tomoBaseName + '_resampled' + tomoExt
-        
+        paramDict['tomoOutName'] = self._getOutputTomoName(tomoFile)
+
         paramDict['newXsize'] = self.newXsize
         paramDict['newYsize'] = self.newYsize
         paramDict['newZsize'] = self.newZsize
@@ -139,11 +133,10 @@ eof\n
 """
         self.runJob(prog, args % paramDict)
 
-        self.tomoList.append(paramDict['tomoOutName'])
-
     def createOutputStep(self):
-        labelledSet = self._genOutputSetOfTomograms(
-            self.tomoList, 'resampled')
+        tomoList = [self._getOutputTomoName(tomo.getFileName())
+                    for tomo in self.inTomograms.get()]
+        labelledSet = self._genOutputSetOfTomograms(tomoList, 'resampled')
         self._defineOutputs(**{OUTPUT_TOMO_NAME: labelledSet})
         self._defineSourceRelation(self.inTomograms.get(), labelledSet)
 
@@ -153,8 +146,10 @@ eof\n
         inTomoSet = self.inTomograms.get()
         tomoSet.copyInfo(inTomoSet)
 
-        outSamplingRate = Ccp4Header(tomoList[0], readHeader=True).getSampling()
-        tomoSet.setSamplingRate(outSamplingRate[0])
+        # Same pixel size as written by resample, no need to read the header
+        outSamplingRate = (inTomoSet.getSamplingRate() * inTomoSet.getDim()[0] /
+                           float(self.newXsize))
+        tomoSet.setSamplingRate(outSamplingRate)
 
         counter = 1
         for file, inTomo in zip(tomoList, inTomoSet):
@@ -166,6 +161,10 @@ eof\n
 
         return tomoSet
 
+    def _getOutputTomoName(self, tomoFile):
+        return self.getWorkingDir() + '/' + OUTPUT_DIR + '/' + \
+            removeBaseExt(tomoFile) + '_resampled' + getExt(tomoFile)
+
     # --------------------------- INFO functions -----------------------------------
     def _citations(self):
 
@@ -36,7 +36,7 @@ from tomo.protocols import ProtTomoBase
 import tomo.objects as tomoObj
 from pwem.protocols import EMProtocol
 from pyworkflow import BETA
-from pyworkflow.protocol import PointerParam, IntParam
+from pyworkflow.protocol import PointerParam, IntParam, STEPS_PARALLEL
 from pyworkflow.utils import *
 from pyworkflow.object import Set
 from tomo.objects import SetOfTiltSeries, TiltSeries
@@ -57,10 +57,9 @@ class ProtTsResample(EMProtocol, ProtTomoBase):
     _possibleOutputs = {OUTPUT_TS_NAME: SetOfTiltSeries}
     _devStatus = BETA
 
-    tsList = []
-
     def __init__(self, **args):
         EMProtocol.__init__(self, **args)
+        self.stepsExecutionMode = STEPS_PARALLEL
 
     # -------------------------- DEFINE param functions ----------------------
     def _defineParams(self, form):
@@ -102,34 +101,37 @@ class ProtTsResample(EMProtocol, ProtTomoBase):
                         label='New Y-Size',
                         help='Volume will be rescaled to this size in Y dimension (voxels)')
 
+        form.addParallelSection(threads=4, mpi=0)
+
     # -------------------------- INSERT steps functions -----------------------
     def _insertAllSteps(self):
-
+        # Resampling of each tilt series is independent and can run in
+        # parallel, while output steps are kept serial since they all
+        # append to the same output set. File names are resolved here so
+        # the parallel steps never access the input set database
+        outputId = None
         for ts in self.inputSetOfTiltSeries.get():
+            tsFile = ts.getFirstItem().getFileName()
+            tsOutName = self._getOutputTsName(tsFile)
 
-            self._insertFunctionStep(self.runTsResample,
-                        ts.getObjId())
+            resampleId = self._insertFunctionStep(self.runTsResample,
+                        tsFile, tsOutName, prerequisites=[])
 
-            self._insertFunctionStep(self.createOutputStep,
-                        ts.getObjId())
-        
-        self._insertFunctionStep('closeStreamStep')
+            deps = [resampleId] if outputId is None else [resampleId, outputId]
+            outputId = self._insertFunctionStep(self.createOutputStep,
+                        ts.getObjId(), tsOutName, prerequisites=deps)
 
-    def runTsResample(self, tsObjId):
+        self._insertFunctionStep('closeStreamStep',
+                                 prerequisites=[] if outputId is None else [outputId])
 
-        prog = Plugin.getProgram('resample')
+    def runTsResample(self, tsFile: str, tsOutName: str):
 
-        ts = self.inputSetOfTiltSeries.get()[tsObjId]
-        firstItem = ts.getFirstItem()
-        tsFile = firstItem.getFileName()
+        prog = Plugin.getProgram('resample')
 
-        tsBaseName = removeBaseExt(tsFile)
-        tsExt = getExt(tsFile)
         paramDict = {}
         paramDict['tsFile'] = tsFile
-        paramDict['tsOutName'] = self.getWorkingDir() + '/' + OUTPUT_DIR + '/' + \
-            tsBaseName + '_resampled' + tsExt
-        
+        paramDict['tsOutName'] = tsOutName
+
         paramDict['newXsize'] = self.newXsize
         paramDict['newYsize'] = self.newYsize
 
@@ -144,19 +146,9 @@ eof\n
 """
         self.runJob(prog, args % paramDict)
 
-        self.tsList.append(paramDict['tsOutName'])
-
-    def createOutputStep(self, tsObjId):
+    def createOutputStep(self, tsObjId, tsOutName: str):
         ts = self.inputSetOfTiltSeries.get()[tsObjId]
 
-        firstItem = ts.getFirstItem()
-        tsFile = firstItem.getFileName()
-        tsBaseName = removeBaseExt(tsFile)
-        tsExt = getExt(tsFile)
-
-        tsOutName = self.getWorkingDir() + '/' + OUTPUT_DIR + '/' + \
-            tsBaseName + '_resampled' + tsExt
-
         tsId = ts.getTsId()
 
         oldSamplingRate = ts.getSamplingRate()
@@ -200,6 +192,10 @@ eof\n
         self._store()
 
     # --------------------------- UTILS functions -------------------------------
+    def _getOutputTsName(self, tsFile: str):
+        return self.getWorkingDir() + '/' + OUTPUT_DIR + '/' + \
+            removeBaseExt(tsFile) + '_resampled' + getExt(tsFile)
+
     def getOutputSetOfTiltSeries(self):
         if hasattr(self, "outputSetOfTiltSeries"):
             self.outputSetOfTiltSeries.enableAppend()
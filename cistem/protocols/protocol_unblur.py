@@ -28,16 +28,19 @@
 # *
 # **************************************************************************
 
-import time
-from math import ceil
-from threading import Thread
+import os
+from collections import namedtuple
+from threading import Thread, Lock, local
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 
 import pyworkflow.utils as pwutils
 
 from pyworkflow.protocol import STEPS_PARALLEL
 from pyworkflow.constants import PROD
 import pyworkflow.protocol.params as params
-from pyworkflow.gui.plotter import Plotter
 from pwem.objects import Image
 from pwem.protocols import ProtAlignMovies
 
@@ -45,6 +48,9 @@ from cistem import Plugin
 from ..convert import readShiftsMovieAlignment
 from ..constants import UNBLUR_BIN
 
+MoviePaths = namedtuple('MoviePaths',
+                        'movieFn micFn shiftsFn plotGlobal psdCorr')
+
 
 class CistemProtUnblur(ProtAlignMovies):
     """ This protocol wraps unblur movie alignment program. """
@@ -56,6 +62,14 @@ class CistemProtUnblur(ProtAlignMovies):
     def __init__(self, **args):
         ProtAlignMovies.__init__(self, **args)
         self.stepsExecutionMode = STEPS_PARALLEL
+        self._workerThreads = []
+        self._workerLock = Lock()
+        self._unblurArgs = None
+        self._plotPool = None
+        self._plotFutures = []
+        self._moviePaths = {}
+        self._movieShifts = {}
+        self._inputSamplingRate = None
 
     def _getConvertExtension(self, filename):
         """ Check whether it is needed to convert to .mrc or not """
@@ -191,7 +205,8 @@ class CistemProtUnblur(ProtAlignMovies):
 
     # --------------------------- STEPS functions -----------------------------
     def _processMovie(self, movie):
-        inputMovies = self.getInputMovies()
+        samplingRate = self._getInputSamplingRate()
+        paths = self._getMoviePaths(movie)
         self._createTifLink(movie)
         self._argsUnblur(movie)
         
@@ -199,12 +214,14 @@ class CistemProtUnblur(ProtAlignMovies):
             self.runJob(self._getProgram(), self._args, env=Plugin.getEnviron())
 
             def _extraWork():
-                outMicFn = self._getMicFn(movie)
+                outMicFn = paths.micFn
 
                 if self.doComputePSD:
-                    self._computePSD(outMicFn, outputFn=self._getPsdCorr(movie))
+                    self._computePSD(outMicFn, outputFn=paths.psdCorr)
 
-                self._saveAlignmentPlots(movie, inputMovies.getSamplingRate())
+                shiftsX, shiftsY = self._getMovieShifts(movie)
+                self._submitAlignmentPlots(movie, samplingRate,
+                                           shiftsX, shiftsY)
 
                 if self._doComputeMicThumbnail():
                     self.computeThumbnail(outMicFn,
@@ -213,12 +230,14 @@ class CistemProtUnblur(ProtAlignMovies):
             if self._useWorkerThread():
                 thread = Thread(target=_extraWork)
                 thread.start()
+                with self._workerLock:
+                    self._workerThreads.append(thread)
             else:
                 _extraWork()
 
         except Exception as e:
             self.error("ERROR: Unblur has failed for %s. %s" % (
-                self._getMovieFn(movie), self._getErrorFromUnblurTxt(movie, e)))
+                paths.movieFn, self._getErrorFromUnblurTxt(movie, e)))
 
     def _getErrorFromUnblurTxt(self, movie, e):
         """ Parse output log for errors.
@@ -238,11 +257,22 @@ class CistemProtUnblur(ProtAlignMovies):
         return [stepId]
 
     def waitForThreadStep(self):
-        # Quick and dirty (maybe desperate) way to wait
-        # if the PSD and thumbnail were computed in a thread
-        # If running in streaming this will not be necessary
-        if self._useWorkerThread():
-            time.sleep(10)  # wait 10 sec for the thread to finish
+        # Wait for the PSD and thumbnail threads
+        # started in _processMovie to finish
+        with self._workerLock:
+            threads, self._workerThreads = self._workerThreads, []
+        for thread in threads:
+            thread.join()
+
+        with self._workerLock:
+            futures, self._plotFutures = self._plotFutures, []
+            pool, self._plotPool = self._plotPool, None
+        for future in futures:
+            if future.exception() is not None:
+                self.error("ERROR: Alignment plot has failed. %s"
+                           % future.exception())
+        if pool is not None:
+            pool.shutdown()
 
     # --------------------------- INFO functions -------------------------------
     def _summary(self):
@@ -289,114 +319,144 @@ class CistemProtUnblur(ProtAlignMovies):
 
     def _argsUnblur(self, movie):
         """ Format arguments to call unblur program. """
+        argsStr, args = self._getUnblurArgs()
+        paths = self._getMoviePaths(movie)
+        args.update({'movieName': paths.movieFn,
+                     'micFnName': paths.micFn,
+                     'shiftsFn': paths.shiftsFn,
+                     'samplingRate': self.samplingRate,
+                     'voltage': movie.getAcquisition().getVoltage()})
+
+        self._args = argsStr % args
+
+    def _getUnblurArgs(self):
+        """ Return the unblur arguments template together with
+        a copy of the movie-independent parameters. Both are
+        computed only once per protocol run.
+        """
+        if self._unblurArgs is None:
+            self._unblurArgs = self._buildUnblurArgs()
+        argsStr, args = self._unblurArgs
+        return argsStr, dict(args)
+
+    def _buildUnblurArgs(self):
         inputMovies = self.getInputMovies()
-        if self.doApplyDoseFilter:
+        doDose = self.doApplyDoseFilter.get()
+        gainFn = inputMovies.getGain()
+        if doDose:
             preExp, dose = self._getCorrectedDose(inputMovies)
         else:
             preExp, dose = 0.0, 0.0
 
-        args = {'movieName': self._getMovieFn(movie),
-                'micFnName': self._getMicFn(movie),
-                'shiftsFn': self._getShiftsFn(movie),
-                'samplingRate': self.samplingRate,
-                'voltage': movie.getAcquisition().getVoltage(),
-                'bfactor': self.bfactor.get(),
+        args = {'bfactor': self.bfactor.get(),
                 'minShiftInitSearch': self.minShiftInitSearch.get(),
                 'OutRadShiftLimit': self.OutRadShiftLimit.get(),
                 'HWVertFourMask': self.HWVertFourMask.get(),
                 'HWHoriFourMask': self.HWHoriFourMask.get(),
                 'terminShiftThreshold': self.terminShiftThreshold.get(),
                 'maximumNumberIterations': self.maximumNumberIterations.get(),
-                'applyDoseFilter': 'YES' if self.doApplyDoseFilter else 'NO',
+                'applyDoseFilter': 'YES' if doDose else 'NO',
                 'doRestoreNoisePwr': 'YES' if self.doRestoreNoisePwr else 'NO',
                 'exposurePerFrame': dose,
                 'binFactor': self.binFactor.get(),
                 'alignFrame0': self.alignFrame0.get(),
                 'alignFrameN': self.alignFrameN.get(),
-                'gainCorrected': 'NO' if inputMovies.getGain() else 'YES',
-                'gainFn': inputMovies.getGain(),
+                'gainCorrected': 'NO' if gainFn else 'YES',
+                'gainFn': gainFn,
                 'preExposureAmount': preExp
                 }
 
-        argsStr = """ << eof > %(shiftsFn)s
-%(movieName)s
-%(micFnName)s
-%(samplingRate)f
-%(binFactor)f
-%(applyDoseFilter)s"""
-
-        if self.doApplyDoseFilter:
-            argsStr += """
-%(voltage)f
-%(exposurePerFrame)f
-%(preExposureAmount)f"""
-
-        argsStr += """
-YES
-%(minShiftInitSearch)f
-%(OutRadShiftLimit)f
-%(bfactor)f
-%(HWVertFourMask)d
-%(HWHoriFourMask)d
-%(terminShiftThreshold)f
-%(maximumNumberIterations)d"""
-
-        if self.doApplyDoseFilter:
-            argsStr += """
-%(doRestoreNoisePwr)s"""
-
-        if inputMovies.getGain():
-            argsStr += """
-%(gainCorrected)s
-%(gainFn)s
-%(alignFrame0)d
-%(alignFrameN)d
-NO
-eof\n
-"""
-        else:
-            argsStr += """
-%(gainCorrected)s
-%(alignFrame0)d
-%(alignFrameN)d
-NO
-eof\n
-"""
-
-        self._args = argsStr % args
+        lines = [' << eof > %(shiftsFn)s',
+                 '%(movieName)s',
+                 '%(micFnName)s',
+                 '%(samplingRate)f',
+                 '%(binFactor)f',
+                 '%(applyDoseFilter)s']
+        if doDose:
+            lines += ['%(voltage)f',
+                      '%(exposurePerFrame)f',
+                      '%(preExposureAmount)f']
+        lines += ['YES',
+                  '%(minShiftInitSearch)f',
+                  '%(OutRadShiftLimit)f',
+                  '%(bfactor)f',
+                  '%(HWVertFourMask)d',
+                  '%(HWHoriFourMask)d',
+                  '%(terminShiftThreshold)f',
+                  '%(maximumNumberIterations)d']
+        if doDose:
+            lines.append('%(doRestoreNoisePwr)s')
+        lines.append('%(gainCorrected)s')
+        if gainFn:
+            lines.append('%(gainFn)s')
+        lines += ['%(alignFrame0)d',
+                  '%(alignFrameN)d',
+                  'NO',
+                  'eof',
+                  '', '']
+        argsStr = '\n'.join(lines)
+
+        return argsStr, args
+
+    def _getMoviePaths(self, movie):
+        """ Return the files used for a movie, computed only once. """
+        movieId = movie.getObjId()
+        paths = self._moviePaths.get(movieId)
+        if paths is None:
+            movieFn = movie.getFileName()
+            if movieFn.endswith("tiff"):
+                movieFn = pwutils.replaceExt(movieFn, "tif")
+            if self.doApplyDoseFilter:
+                micFn = self._getExtraPath(self._getOutputMicWtName(movie))
+            else:
+                micFn = self._getExtraPath(self._getOutputMicName(movie))
+            paths = MoviePaths(
+                movieFn=movieFn,
+                micFn=micFn,
+                shiftsFn=self._getNameExt(movie, '_shifts', 'txt', extra=True),
+                plotGlobal=self._getNameExt(movie, '_global_shifts', 'png',
+                                            extra=True),
+                psdCorr=self._getNameExt(movie, '_psd', 'png', extra=True))
+            self._moviePaths[movieId] = paths
+        return paths
 
     def _getMovieFn(self, movie):
-        movieFn = movie.getFileName()
-        if movieFn.endswith("tiff"):
-            return pwutils.replaceExt(movieFn, "tif")
-        else:
-            return movieFn
+        return self._getMoviePaths(movie).movieFn
 
     def _createTifLink(self, movie):
         # unblur recognises only tif, not tiff
+        # a hard link avoids the symlink indirection on every read
         movieFn = movie.getFileName()
         if movieFn.endswith("tiff"):
-            pwutils.createLink(movieFn, self._getMovieFn(movie))
+            linkFn = self._getMovieFn(movie)
+            try:
+                os.link(movieFn, linkFn)
+            except FileExistsError:
+                pass
+            except OSError:  # e.g. cross-device, fall back to a symlink
+                pwutils.createLink(movieFn, linkFn)
 
     def _getMicFn(self, movie):
-        if self.doApplyDoseFilter:
-            return self._getExtraPath(self._getOutputMicWtName(movie))
-        else:
-            return self._getExtraPath(self._getOutputMicName(movie))
+        return self._getMoviePaths(movie).micFn
 
     def _getShiftsFn(self, movie):
-        return self._getExtraPath(self._getMovieRoot(movie) + '_shifts.txt')
+        return self._getMoviePaths(movie).shiftsFn
 
     def _getMovieShifts(self, movie):
-        """ Returns the x and y shifts for the alignment of this movie. """
-        pixSize = movie.getSamplingRate()
-        shiftFn = self._getShiftsFn(movie)
-        xShifts, yShifts = readShiftsMovieAlignment(shiftFn)
-        # convert shifts from Angstroms to px
-        xShiftsCorr = [x / pixSize for x in xShifts]
-        yShiftsCorr = [y / pixSize for y in yShifts]
-
-        return xShiftsCorr, yShiftsCorr
+        """ Returns the x and y shifts for the alignment of this movie.
+        The shifts file is parsed only once per movie.
+        """
+        movieId = movie.getObjId()
+        shifts = self._movieShifts.get(movieId)
+        if shifts is None:
+            pixSize = movie.getSamplingRate()
+            shiftFn = self._getShiftsFn(movie)
+            # convert shifts from Angstroms to px
+            xShiftsCorr, yShiftsCorr = (readShiftsMovieAlignment(shiftFn) /
+                                        pixSize).tolist()
+            shifts = self._movieShifts[movieId] = xShiftsCorr, yShiftsCorr
+
+        return shifts
 
     def _doComputeMicThumbnail(self):
         return self.doComputeMicThumbnail
@@ -427,18 +487,27 @@ eof\n
         return self._getExtraPath(fn) if extra else fn
 
     def _getPlotGlobal(self, movie):
-        return self._getNameExt(movie, '_global_shifts', 'png', extra=True)
+        return self._getMoviePaths(movie).plotGlobal
 
     def _getPsdCorr(self, movie):
-        return self._getNameExt(movie, '_psd', 'png', extra=True)
+        return self._getMoviePaths(movie).psdCorr
 
-    def _saveAlignmentPlots(self, movie, pixSize):
+    def _saveAlignmentPlots(self, movie, pixSize, shiftsX, shiftsY):
         """ Compute alignment shift plots and save to file as png images. """
-        shiftsX, shiftsY = self._getMovieShifts(movie)
         first, _ = self._getFrameRange(movie.getNumberOfFrames(), 'align')
-        plotter = createGlobalAlignmentPlot(shiftsX, shiftsY, first, pixSize)
-        plotter.savefig(self._getPlotGlobal(movie))
-        plotter.close()
+        figure = createGlobalAlignmentPlot(shiftsX, shiftsY, first, pixSize)
+        figure.savefig(self._getPlotGlobal(movie))
+
+    def _submitAlignmentPlots(self, movie, pixSize, shiftsX, shiftsY):
+        """ Render the alignment plots in a shared pool of threads,
+        so they do not delay the alignment of the next movie.
+        """
+        with self._workerLock:
+            if self._plotPool is None:
+                self._plotPool = ThreadPoolExecutor(max_workers=2)
+            self._plotFutures.append(
+                self._plotPool.submit(self._saveAlignmentPlots, movie, pixSize,
+                                      shiftsX, shiftsY))
 
     def _useWorkerThread(self):
         return '--use_worker_thread' in self.extraProtocolParams.get()
@@ -446,6 +515,12 @@ eof\n
     def getInputMovies(self):
         return self.inputMovies.get()
 
+    def _getInputSamplingRate(self):
+        """ Sampling rate of the input movies, read only once. """
+        if self._inputSamplingRate is None:
+            self._inputSamplingRate = self.getInputMovies().getSamplingRate()
+        return self._inputSamplingRate
+
     def _createOutputMicrographs(self):
         return not self.doApplyDoseFilter
 
@@ -453,55 +528,62 @@ eof\n
         return self.doApplyDoseFilter
 
 
+_plotLocal = local()
+
+
+def _getAlignmentFigure():
+    """ Return the global alignment figure and its axes. They are
+    created once per thread and reused for every movie.
+    """
+    if not hasattr(_plotLocal, 'figure'):
+        # same size as the default pyworkflow Plotter figure
+        figure = Figure(figsize=(8, 6), dpi=100)
+        FigureCanvasAgg(figure)
+        ax_px = figure.add_subplot(111)
+        ax_ang = ax_px.twiny()
+        ax_ang2 = ax_px.twinx()
+        _plotLocal.figure = figure
+        _plotLocal.axes = ax_px, ax_ang, ax_ang2
+    return _plotLocal.figure, _plotLocal.axes
+
+
 def createGlobalAlignmentPlot(meanX, meanY, first, pixSize):
-    """ Create a plotter with the shift per frame. """
-    sumMeanX = []
-    sumMeanY = []
+    """ Draw the shift per frame, return the (reused) figure. """
+    sumMeanX = np.asarray(meanX)
+    sumMeanY = np.asarray(meanY)
 
     def px_to_ang(apx):
         y1, y2 = apx.get_ylim()
         x1, x2 = apx.get_xlim()
         ax_ang2.set_ylim(y1*pixSize, y2*pixSize)
         ax_ang.set_xlim(x1*pixSize, x2*pixSize)
-        ax_ang.figure.canvas.draw()
-        ax_ang2.figure.canvas.draw()
 
-    figureSize = (6, 4)
-    plotter = Plotter(*figureSize)
-    figure = plotter.getFigure()
-    ax_px = figure.add_subplot(111)
+    figure, (ax_px, ax_ang, ax_ang2) = _getAlignmentFigure()
+    # clearing also drops the callbacks connected for the previous movie
+    ax_px.clear()
     ax_px.grid()
     ax_px.set_xlabel('Shift x (px)')
     ax_px.set_ylabel('Shift y (px)')
-
-    ax_ang = ax_px.twiny()
     ax_ang.set_xlabel('Shift x (A)')
-    ax_ang2 = ax_px.twinx()
     ax_ang2.set_ylabel('Shift y (A)')
 
-    i = first
-    skipLabels = ceil(len(meanX)/10.0)
-    labelTick = 1
+    skipLabels = max(1, (len(sumMeanX) + 9) // 10)
 
-    for x, y in zip(meanX, meanY):
-        sumMeanX.append(x)
-        sumMeanY.append(y)
-        if labelTick == 1:
-            ax_px.text(x - 0.02, y + 0.02, str(i))
-            labelTick = skipLabels
-        else:
-            labelTick -= 1
-        i += 1
+    for i in range(0, len(sumMeanX), skipLabels):
+        ax_px.text(sumMeanX[i] - 0.02, sumMeanY[i] + 0.02, str(first + i))
 
     # automatically update lim of ax_ang when lim of ax_px changes.
     ax_px.callbacks.connect("ylim_changed", px_to_ang)
     ax_px.callbacks.connect("xlim_changed", px_to_ang)
 
+    # one collection for all frame markers, first frame highlighted
+    colors = ['r'] + ['y'] * (len(sumMeanX) - 1)
+    sizes = np.full(len(sumMeanX), 36)
+    sizes[:1] = 100
     ax_px.plot(sumMeanX, sumMeanY, color='b')
-    ax_px.plot(sumMeanX, sumMeanY, 'yo')
-    ax_px.plot(sumMeanX[0], sumMeanY[0], 'ro', markersize=10, linewidth=0.5)
+    ax_px.scatter(sumMeanX, sumMeanY, c=colors, s=sizes, zorder=3)
     ax_px.set_title('Global frame alignment')
 
-    plotter.tightLayout()
+    figure.tight_layout()
 
-    return plotter
+    return figure
@@ -28,9 +28,11 @@ from pyworkflow.tests import DataSet
 from pyworkflow.utils import weakImport
 
 from .test_protocols_cistem import TestCtffind4
-from .test_protocols_cistem_movies import TestMoviesBase, TestUnblur
+from .test_convert_cistem import TestSplitParticleRanges, TestWriteMrcStack
+from .test_protocols_cistem_movies import (TestMoviesBase, TestUnblur,
+                                          TestGlobalAlignmentPlot)
 with weakImport("tomo"):
-    from .tomo_tests import TestCtffind4Ts
+    from .tomo_tests import TestCtffind4Ts, TestTsResample
 
 DataSet(name='tutorialDataImodCTF',
         folder='tutorialDataImodCTF',
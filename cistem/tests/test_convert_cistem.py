@@ -0,0 +1,170 @@
+# **************************************************************************
+# *
+# * Authors:    Grigory Sharov (gsharov@mrc-lmb.cam.ac.uk)
+# *
+# * MRC Laboratory of Molecular Biology (MRC-LMB)
+# *
+# * This program is free software; you can redistribute it and/or modify
+# * it under the terms of the GNU General Public License as published by
+# * the Free Software Foundation; either version 3 of the License, or
+# * (at your option) any later version.
+# *
+# * This program is distributed in the hope that it will be useful,
+# * but WITHOUT ANY WARRANTY; without even the implied warranty of
+# * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# * GNU General Public License for more details.
+# *
+# * You should have received a copy of the GNU General Public License
+# * along with this program; if not, write to the Free Software
+# * Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA
+# * 02111-1307  USA
+# *
+# *  All comments concerning this program package may be sent to the
+# *  e-mail address 'scipion@cnb.csic.es'
+# *
+# **************************************************************************
+
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from pyworkflow.tests import BaseTest
+
+from ..convert import splitParticleRanges, writeMrcStack
+
+
+class TestSplitParticleRanges(BaseTest):
+    def _checkRanges(self, numPtcls, jobs):
+        ranges = splitParticleRanges(numPtcls, jobs)
+        self.assertEqual(len(ranges), min(numPtcls, jobs))
+        self.assertEqual(ranges[0][0], 1)
+        self.assertEqual(ranges[-1][1], numPtcls)
+        for (_, last), (first, _) in zip(ranges[:-1], ranges[1:]):
+            self.assertEqual(first, last + 1)
+        covered = [i for first, last in ranges
+                   for i in range(first, last + 1)]
+        self.assertEqual(covered, list(range(1, numPtcls + 1)))
+        for first, last in ranges:
+            self.assertLessEqual(first, last)
+
+    def testEvenSplit(self):
+        self._checkRanges(100, 4)
+
+    def testUnevenSplit(self):
+        self._checkRanges(101, 7)
+
+    def testSingleJob(self):
+        self._checkRanges(10, 1)
+
+    def testFewerParticlesThanJobs(self):
+        self._checkRanges(3, 8)
+        self.assertEqual(splitParticleRanges(3, 8), [(1, 1), (2, 2), (3, 3)])
+
+
+class TestWriteMrcStack(BaseTest):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.rng = np.random.default_rng(0)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def _writeMrc(self, name, nz, nx=8, ny=6, extHeader=0, mode=2):
+        """ Write a synthetic little-endian MRC stack, return its
+        filename and data. """
+        fn = os.path.join(self.tmpDir, name)
+        data = self.rng.random((nz, ny, nx), dtype=np.float32)
+        header = np.zeros(256, dtype='<i4')
+        floatHeader = header.view('<f4')
+        header[:4] = nx, ny, nz, mode
+        header[7:10] = nx, ny, nz
+        floatHeader[10:13] = nx * 1.5, ny * 1.5, nz * 1.5
+        header[16:19] = 1, 2, 3
+        floatHeader[19:22] = data.min(), data.max(), data.mean()
+        header[22] = 1
+        header[23] = extHeader
+        header.view(np.uint8)[208:216] = list(b'MAP DD\0\0')
+        floatHeader[54] = data.std()
+        with open(fn, 'wb') as f:
+            f.write(header.tobytes())
+            f.write(self.rng.bytes(extHeader))
+            f.write(data.tobytes())
+        return fn, data
+
+    def _readOutput(self, fn):
+        header = np.fromfile(fn, dtype='<i4', count=256)
+        data = np.fromfile(fn, dtype='<f4', offset=1024)
+        return header, data.reshape(header[2], header[1], header[0])
+
+    def testOutOfOrderAndRepeated(self):
+        inFn, inData = self._writeMrc('input.mrcs', 5)
+        outFn = os.path.join(self.tmpDir, 'output.mrc')
+        self.assertTrue(writeMrcStack([(3, inFn), (1, inFn), (3, inFn),
+                                       (5, inFn)], outFn))
+        _, outData = self._readOutput(outFn)
+        np.testing.assert_array_equal(outData, inData[[2, 0, 2, 4]])
+
+    def testSingleImageIndexZero(self):
+        inFn, inData = self._writeMrc('single.mrc', 1)
+        outFn = os.path.join(self.tmpDir, 'output.mrc')
+        self.assertTrue(writeMrcStack([(0, inFn), (1, inFn)], outFn))
+        _, outData = self._readOutput(outFn)
+        np.testing.assert_array_equal(outData, inData[[0, 0]])
+
+    def testExtendedHeaderAndSuffix(self):
+        extFn, extData = self._writeMrc('ext.mrcs', 3, extHeader=4 * 1024)
+        plainFn, plainData = self._writeMrc('plain.mrcs', 2)
+        outFn = os.path.join(self.tmpDir, 'output.mrc')
+        self.assertTrue(writeMrcStack([(2, extFn + ':mrcs'), (1, plainFn),
+                                       (3, extFn), (2, plainFn + ':mrcs')],
+                                      outFn))
+        _, outData = self._readOutput(outFn)
+        expected = np.stack([extData[1], plainData[0],
+                             extData[2], plainData[1]])
+        np.testing.assert_array_equal(outData, expected)
+
+    def testHeaderFields(self):
+        inFn, _ = self._writeMrc('ext.mrcs', 4, nx=8, ny=6, extHeader=512)
+        inHeader = np.fromfile(inFn, dtype='<i4', count=256)
+        outFn = os.path.join(self.tmpDir, 'output.mrc')
+        self.assertTrue(writeMrcStack([(4, inFn), (2, inFn), (1, inFn)],
+                                      outFn))
+        self.assertEqual(os.path.getsize(outFn), 1024 + 3 * 6 * 8 * 4)
+        header, _ = self._readOutput(outFn)
+        floatHeader = header.view('<f4')
+        self.assertEqual(list(header[:4]), [8, 6, 3, 2])  # nx, ny, nz, mode
+        self.assertEqual(list(header[7:10]), [8, 6, 1])  # mx, my, mz
+        self.assertAlmostEqual(floatHeader[12], 1.5)  # cella z
+        self.assertEqual(header[22], 0)  # ispg
+        self.assertEqual(header[23], 0)  # nsymbt
+        self.assertGreater(floatHeader[19], floatHeader[20])  # dmin > dmax
+        self.assertLess(floatHeader[54], 0)  # rms
+        # untouched fields are kept from the input header
+        for field in (10, 11, 16, 17, 18, 53):
+            self.assertEqual(header[field], inHeader[field])
+
+    def testUnsupportedInputs(self):
+        outFn = os.path.join(self.tmpDir, 'output.mrc')
+        intFn, _ = self._writeMrc('int.mrcs', 2, mode=1)
+        self.assertFalse(writeMrcStack([(1, intFn)], outFn))
+        smallFn, _ = self._writeMrc('small.mrcs', 2, nx=4)
+        bigFn, _ = self._writeMrc('big.mrcs', 2, nx=8)
+        self.assertFalse(writeMrcStack([(1, smallFn), (1, bigFn)], outFn))
+        spiFn = os.path.join(self.tmpDir, 'input.spi')
+        shutil.copy(bigFn, spiFn)
+        self.assertFalse(writeMrcStack([(1, spiFn)], outFn))
+        self.assertFalse(os.path.exists(outFn))
+
+    def testTruncatedInputs(self):
+        """ Files shorter than their header claims are not supported. """
+        outFn = os.path.join(self.tmpDir, 'output.mrc')
+        truncFn, _ = self._writeMrc('trunc.mrcs', 3)
+        with open(truncFn, 'r+b') as f:
+            f.truncate(1024 + 2 * 6 * 8 * 4)
+        self.assertFalse(writeMrcStack([(1, truncFn)], outFn))
+        extFn, _ = self._writeMrc('ext.mrcs', 2, extHeader=256)
+        with open(extFn, 'r+b') as f:
+            f.truncate(os.path.getsize(extFn) - 4)
+        self.assertFalse(writeMrcStack([(1, extFn)], outFn))
+        self.assertFalse(os.path.exists(outFn))
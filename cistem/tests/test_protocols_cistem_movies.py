@@ -25,11 +25,18 @@
 # *
 # **************************************************************************
 
+import os
+import shutil
+import struct
+import tempfile
+import numpy as np
+
 from pyworkflow.tests import BaseTest, DataSet, setupTestProject
 from pwem.protocols import ProtImportMovies
 from pyworkflow.utils import magentaStr, exists
 
 from ..protocols import CistemProtUnblur
+from ..protocols.protocol_unblur import createGlobalAlignmentPlot
 
 
 class TestMoviesBase(BaseTest):
@@ -88,3 +95,29 @@ class TestUnblur(TestMoviesBase):
         for mic in outputMics:
             micFn = mic.getFileName()
             self.assertTrue(exists(self.proj.getPath(micFn)))
+            plotFn = self.proj.getPath(mic.plotGlobal.getFileName())
+            self.assertEqual(getPngSize(plotFn), (800, 600))
+
+
+def getPngSize(filename):
+    """ Return (width, height) read from a png IHDR chunk. """
+    with open(filename, 'rb') as f:
+        return struct.unpack('>II', f.read(24)[16:24])
+
+
+class TestGlobalAlignmentPlot(BaseTest):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testPlotSize(self):
+        """ The plot must keep the 800x600 size of the Plotter figure. """
+        shifts = np.cumsum(np.random.default_rng(0).random((2, 20)), axis=1)
+        for i, n in enumerate((20, 7)):  # the figure is reused
+            plotFn = os.path.join(self.tmpDir, 'plot%d.png' % i)
+            figure = createGlobalAlignmentPlot(shifts[0, :n], shifts[1, :n],
+                                               1, 1.5)
+            figure.savefig(plotFn)
+            self.assertEqual(getPngSize(plotFn), (800, 600))
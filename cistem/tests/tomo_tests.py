@@ -27,20 +27,13 @@
 import os
 from pyworkflow.tests import BaseTest, DataSet, setupTestProject
 from pyworkflow.utils import magentaStr
+from pwem.emlib.image import ImageHandler
 
 from tomo.protocols import ProtImportTs
-from ..protocols import CistemProtTsCtffind
+from ..protocols import CistemProtTsCtffind, ProtTsResample
 
 
 class TestBase(BaseTest):
-    @classmethod
-    def runImportTiltSeries(cls, **kwargs):
-        cls.protImportTS = cls.newProtocol(ProtImportTs, **kwargs)
-        cls.launchProtocol(cls.protImportTS)
-        return cls.protImportTS
-
-
-class TestCtffind4Ts(TestBase):
     @classmethod
     def setUpClass(cls):
         setupTestProject(cls)
@@ -55,6 +48,14 @@ class TestCtffind4Ts(TestBase):
                                                    amplitudeContrast=0.07,
                                                    anglesFrom=2)
 
+    @classmethod
+    def runImportTiltSeries(cls, **kwargs):
+        cls.protImportTS = cls.newProtocol(ProtImportTs, **kwargs)
+        cls.launchProtocol(cls.protImportTS)
+        return cls.protImportTS
+
+
+class TestCtffind4Ts(TestBase):
     def testCtffindTs(self):
         print(magentaStr("\n==> Testing cistem - ctffind:"))
         protCTF = CistemProtTsCtffind(lowRes=50, highRes=13,
@@ -63,3 +64,23 @@ class TestCtffind4Ts(TestBase):
         self.launchProtocol(protCTF)
 
         self.assertIsNotNone(protCTF.outputSetOfCTFTomoSeries, "SetOfCTFTomoSeries has not been produced.")
+
+
+class TestTsResample(TestBase):
+    def testResampleTs(self):
+        print(magentaStr("\n==> Testing cistem - resample tilt series:"))
+        protResample = ProtTsResample(newXsize=512, newYsize=512)
+        protResample.inputSetOfTiltSeries.set(self.protImportTS.outputTiltSeries)
+        self.launchProtocol(protResample)
+
+        inTsSet = self.protImportTS.outputTiltSeries
+        outTsSet = getattr(protResample, 'outputSetOfTiltSeries', None)
+        self.assertIsNotNone(outTsSet, "SetOfTiltSeries has not been produced.")
+        self.assertEqual(outTsSet.getSize(), inTsSet.getSize())
+
+        inSizes = {ts.getTsId(): ts.getSize() for ts in inTsSet}
+        ih = ImageHandler()
+        for ts in outTsSet:
+            self.assertEqual(ts.getSize(), inSizes[ts.getTsId()])
+            x, _, _, _ = ih.getDimensions(ts.getFirstItem().getFileName())
+            self.assertEqual(x, 512)